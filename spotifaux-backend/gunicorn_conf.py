@@ -0,0 +1,16 @@
+# Gunicorn settings for running the API with several Uvicorn worker processes.
+# Usage: gunicorn -c gunicorn_conf.py main:app
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+# Password hashing is CPU-bound; spread it over processes rather than threads
+workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+# Uvicorn worker with uvloop/httptools and a limit_concurrency bound (see workers.py)
+worker_class = "workers.SpotifauxUvicornWorker"
+
+# Import the app once in the master so the track catalog and indexes are built
+# a single time and shared copy-on-write by the forked workers.
+preload_app = True
+
+accesslog = "-"
@@ -2,16 +2,24 @@ from fastapi import FastAPI, Request, HTTPException, Depends, Response, Cookie
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import BaseModel, BeforeValidator, EmailStr
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Annotated, Optional, Dict, Any
 from datetime import datetime, timedelta
+from functools import lru_cache
+from contextlib import asynccontextmanager, closing
 from jose import jwt, JWTError
 from passlib.context import CryptContext
+import anyio.to_thread
+import bisect
+import hashlib
 import os
 import json
+import sqlite3
+import time
 import logging
+import orjson
 
 # ----------------------------
 # Logging
@@ -26,23 +34,57 @@ SECRET_KEY = os.getenv("SECRET_KEY", "change-me-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
 
-# Use bcrypt_sha256 to avoid 72-byte limitation and normalize inputs
-pwd_context = CryptContext(schemes=["bcrypt_sha256"], deprecated="auto")
-
-
-def _ensure_str(p) -> str:
-    if isinstance(p, bytes):
-        return p.decode("utf-8", errors="ignore")
-    return str(p)
+# New hashes use argon2id; bcrypt_sha256 is kept so existing users can still log in
+# and get transparently re-hashed on their next successful login.
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt_sha256"],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__memory_cost=19456,
+    argon2__time_cost=2,
+    argon2__parallelism=1,
+)
 
 
 def hash_password(password: str) -> str:
-    password = _ensure_str(password)
     return pwd_context.hash(password)
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(_ensure_str(plain_password), _ensure_str(hashed_password))
+# Verified against when there is no usable stored hash, so every login attempt costs one KDF.
+# bcrypt_sha256 (cost 12) is far slower than our argon2id settings, so while any legacy
+# hashes are still stored the dummy uses it: unknown emails then take as long as the
+# slowest real accounts. Remaining leak: until every user has logged in once more, an
+# already-migrated (argon2) account still answers faster than an unknown email.
+DUMMY_HASHES = {
+    "argon2": pwd_context.hash("dummy-password-for-timing"),
+    "bcrypt_sha256": pwd_context.handler("bcrypt_sha256").hash("dummy-password-for-timing"),
+}
+# Ids of users whose stored hash is not argon2 yet; kept in sync with the user indexes
+LEGACY_HASH_USERS: set[int] = set()
+
+
+def track_hash_scheme(user: Dict[str, Any]) -> None:
+    if pwd_context.identify(user.get("password") or "") == "argon2":
+        LEGACY_HASH_USERS.discard(int(user["id"]))
+    else:
+        LEGACY_HASH_USERS.add(int(user["id"]))
+
+
+def _dummy_verify(plain_password: str) -> None:
+    pwd_context.verify(plain_password, DUMMY_HASHES["bcrypt_sha256" if LEGACY_HASH_USERS else "argon2"])
+
+
+def verify_password(plain_password: str, hashed_password: Optional[str]) -> tuple[bool, Optional[str]]:
+    """Return (valid, new_hash); new_hash is set when the stored hash should be upgraded."""
+    if not hashed_password or pwd_context.identify(hashed_password) is None:
+        _dummy_verify(plain_password)
+        return False, None
+    try:
+        return pwd_context.verify_and_update(plain_password, hashed_password)
+    except ValueError:
+        # identify() only checks the prefix; a malformed body fails here instead
+        _dummy_verify(plain_password)
+        return False, None
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
@@ -52,6 +94,28 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+@lru_cache(maxsize=4096)
+def _decode_token_cached(token: str) -> dict:
+    # Tokens are immutable for their lifetime, so the signature check only has to run once.
+    # Expiry is re-checked by the caller since a cached payload can outlive its token.
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+
+# ----------------------------
+# Runtime
+# ----------------------------
+# Cap on anyio worker threads per process. Covers password hashing (run via
+# anyio.to_thread) plus Starlette's own offloads such as StaticFiles reads.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+# ----------------------------
+# Audio delivery
+# ----------------------------
+# In production a reverse proxy serves /audio with sendfile; set SERVE_AUDIO=false to
+# skip the in-app mount and AUDIO_BASE_URL to point preview links at the proxy.
+SERVE_AUDIO = os.getenv("SERVE_AUDIO", "true").lower() == "true"
+AUDIO_BASE_URL = os.getenv("AUDIO_BASE_URL", "").rstrip("/")
+
 # ----------------------------
 # Paths
 # ----------------------------
@@ -61,11 +125,22 @@ AUDIO_DIR = ROOT / "audio"
 TRACK_DATA_FILE = DB / "tracks.json"
 USER_DATA_FILE = DB / "users.json"
 PLAYLIST_DATA_FILE = DB / "playlists.json"
+DATABASE_FILE = DB / "app.db"
+# SQLite calls run on the event loop (they are sub-millisecond when uncontended), so a
+# lock held by another worker must not stall this one for long: wait briefly, then 503.
+DB_BUSY_TIMEOUT_SECONDS = float(os.getenv("DB_BUSY_TIMEOUT_SECONDS", "0.1"))
 
 # ----------------------------
 # App setup
 # ----------------------------
-app = FastAPI(title="Spotifaux API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    yield
+    close_db()
+
+
+app = FastAPI(title="Spotifaux API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -81,61 +156,371 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     logger.error("Validation error on %s %s: %s", request.method, request.url, exc.errors())
     return JSONResponse(status_code=422, content={"detail": exc.errors()})
 
-# Serve static audio files
-app.mount("/audio", StaticFiles(directory=str(AUDIO_DIR)), name="audio")
+
+@app.exception_handler(sqlite3.OperationalError)
+async def database_error_handler(request: Request, exc: sqlite3.OperationalError):
+    if "locked" in str(exc) or "busy" in str(exc):
+        logger.warning("Database busy on %s %s: %s", request.method, request.url, exc)
+        return JSONResponse(status_code=503, content={"detail": "Database busy, please retry"})
+    logger.exception("Database error on %s %s", request.method, request.url)
+    return JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
+
+# Serve static audio files (dev only when a proxy handles /audio)
+if SERVE_AUDIO:
+    app.mount("/audio", StaticFiles(directory=str(AUDIO_DIR)), name="audio")
 
 # ----------------------------
-# Load data
+# Database (SQLite)
 # ----------------------------
-with open(TRACK_DATA_FILE, "r", encoding="utf-8") as f:
-    RAW_TRACKS = json.load(f)
-logger.info("Loaded %d tracks from %s", len(RAW_TRACKS), TRACK_DATA_FILE)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    password TEXT NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    role TEXT NOT NULL DEFAULT 'user'
+);
+CREATE TABLE IF NOT EXISTS playlists (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    track_id INTEGER NOT NULL,
+    PRIMARY KEY (playlist_id, position)
+);
+-- One row per committed mutation, so other worker processes can reload just those rows
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    row_id INTEGER NOT NULL
+);
+"""
+# How many change rows to keep; a worker further behind than this does a full reload
+CHANGES_KEPT = 10000
+# PRAGMA user_version is bumped once the legacy JSON files have been imported
+SCHEMA_VERSION_IMPORTED = 1
+
+
+def open_database(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _write_playlist_tracks(conn: sqlite3.Connection, pid: int, track_ids: list) -> None:
+    conn.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (pid,))
+    conn.executemany(
+        "INSERT INTO playlist_tracks (playlist_id, position, track_id) VALUES (?, ?, ?)",
+        [(pid, pos, int(tid)) for pos, tid in enumerate(track_ids)],
+    )
 
-with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
-    RAW_USERS = json.load(f)
-logger.info("Loaded %d users from %s", len(RAW_USERS), USER_DATA_FILE)
 
-try:
-    with open(PLAYLIST_DATA_FILE, "r", encoding="utf-8") as f:
-        RAW_PLAYLISTS = json.load(f)
-except FileNotFoundError:
-    RAW_PLAYLISTS = []
-logger.info("Loaded %d playlists from %s", len(RAW_PLAYLISTS), PLAYLIST_DATA_FILE)
+def import_json_stores(conn: sqlite3.Connection) -> None:
+    """One-shot import of the legacy users/playlists JSON files into an empty database."""
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION_IMPORTED:
+        return
+
+    users, playlists = [], []
+    if USER_DATA_FILE.exists():
+        with open(USER_DATA_FILE, "r", encoding="utf-8") as f:
+            users = json.load(f)
+    if PLAYLIST_DATA_FILE.exists():
+        with open(PLAYLIST_DATA_FILE, "r", encoding="utf-8") as f:
+            playlists = json.load(f)
+
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (id, email, password, name, role) VALUES (?, ?, ?, ?, ?)",
+            [
+                (int(u["id"]), u["email"].lower(), u["password"], u.get("name", ""), u.get("role", "user"))
+                for u in users
+            ],
+        )
+        for pl in playlists:
+            conn.execute(
+                "INSERT OR IGNORE INTO playlists (id, user_id, name, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (int(pl["id"]), int(pl["user_id"]), pl["name"], pl.get("created_at"), pl.get("updated_at")),
+            )
+            _write_playlist_tracks(conn, int(pl["id"]), pl.get("tracks", []))
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION_IMPORTED}")
+    logger.info("Imported %d users and %d playlists from JSON", len(users), len(playlists))
+
+
+def load_users(conn: sqlite3.Connection) -> list:
+    rows = conn.execute("SELECT id, email, password, name, role FROM users ORDER BY id")
+    return [dict(r) for r in rows]
+
+
+def load_playlists(conn: sqlite3.Connection) -> list:
+    tracks_by_pl: Dict[int, list] = {}
+    for r in conn.execute("SELECT playlist_id, track_id FROM playlist_tracks ORDER BY playlist_id, position"):
+        tracks_by_pl.setdefault(r["playlist_id"], []).append(r["track_id"])
+    rows = conn.execute("SELECT id, user_id, name, created_at, updated_at FROM playlists ORDER BY id")
+    playlists = []
+    for r in rows:
+        pl = dict(r)
+        pl["tracks"] = tracks_by_pl.get(pl["id"], [])
+        playlists.append(pl)
+    return playlists
+
+
+def load_user(conn: sqlite3.Connection, uid: int) -> Optional[Dict[str, Any]]:
+    row = conn.execute("SELECT id, email, password, name, role FROM users WHERE id = ?", (uid,)).fetchone()
+    return dict(row) if row else None
+
+
+def load_playlist(conn: sqlite3.Connection, pid: int) -> Optional[Dict[str, Any]]:
+    row = conn.execute(
+        "SELECT id, user_id, name, created_at, updated_at FROM playlists WHERE id = ?", (pid,)
+    ).fetchone()
+    if row is None:
+        return None
+    pl = dict(row)
+    pl["tracks"] = [
+        r["track_id"]
+        for r in conn.execute("SELECT track_id FROM playlist_tracks WHERE playlist_id = ? ORDER BY position", (pid,))
+    ]
+    return pl
 
-USERS_BY_EMAIL: Dict[str, Dict[str, Any]] = {u["email"].lower(): u for u in RAW_USERS}
-TRACK_BY_ID: Dict[int, Dict[str, Any]] = {int(t["id"]): t for t in RAW_TRACKS}
-
-# ----------------------------
-# Helpers: file persistence
-# ----------------------------
-def save_users_to_file() -> None:
-    with open(USER_DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(RAW_USERS, f, ensure_ascii=False, indent=2)
 
+def last_change_seq(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
 
-def save_playlists_to_file() -> None:
-    with open(PLAYLIST_DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(RAW_PLAYLISTS, f, ensure_ascii=False, indent=2)
 
+# ----------------------------
+# Load data
+# ----------------------------
+RAW_TRACKS = orjson.loads(TRACK_DATA_FILE.read_bytes())
+logger.info("Loaded %d tracks from %s", len(RAW_TRACKS), TRACK_DATA_FILE)
 
-def next_user_id() -> int:
-    return max((int(u["id"]) for u in RAW_USERS), default=0) + 1
+# Users/playlists and their indexes are filled in place, so a reload (see sync_from_db)
+# is visible to every function holding a reference to these containers.
+USERS_BY_EMAIL: Dict[str, Dict[str, Any]] = {}
+USERS_BY_ID: Dict[int, Dict[str, Any]] = {}
+PLAYLIST_BY_ID: Dict[int, Dict[str, Any]] = {}
+# user_id -> {playlist_id: playlist}; dicts keep creation order and allow O(1) removal
+PLAYLISTS_BY_USER: Dict[int, Dict[int, Dict[str, Any]]] = {}
+
+
+def set_users(users: list) -> None:
+    USERS_BY_EMAIL.clear()
+    USERS_BY_EMAIL.update((u["email"].lower(), u) for u in users)
+    USERS_BY_ID.clear()
+    USERS_BY_ID.update((int(u["id"]), u) for u in users)
+    LEGACY_HASH_USERS.clear()
+    for u in users:
+        track_hash_scheme(u)
+
+
+def set_playlists(playlists: list) -> None:
+    PLAYLIST_BY_ID.clear()
+    PLAYLIST_BY_ID.update((int(p["id"]), p) for p in playlists)
+    PLAYLISTS_BY_USER.clear()
+    for p in playlists:
+        PLAYLISTS_BY_USER.setdefault(int(p["user_id"]), {})[int(p["id"])] = p
+
+
+def apply_user(uid: int, row: Optional[Dict[str, Any]]) -> None:
+    """Bring one in-memory user in line with its database row (None = deleted)."""
+    current = USERS_BY_ID.get(uid)
+    if current is not None:
+        USERS_BY_EMAIL.pop(current["email"].lower(), None)
+    if row is None:
+        USERS_BY_ID.pop(uid, None)
+        LEGACY_HASH_USERS.discard(uid)
+        return
+    if current is None:
+        current = USERS_BY_ID[uid] = row
+    else:
+        current.update(row)  # in place: request handlers may hold a reference
+    USERS_BY_EMAIL[current["email"].lower()] = current
+    track_hash_scheme(current)
+
+
+def apply_playlist(pid: int, row: Optional[Dict[str, Any]]) -> None:
+    """Bring one in-memory playlist in line with its database row (None = deleted)."""
+    current = PLAYLIST_BY_ID.get(pid)
+    if row is None:
+        if current is not None:
+            del PLAYLIST_BY_ID[pid]
+            PLAYLISTS_BY_USER.get(int(current["user_id"]), {}).pop(pid, None)
+        return
+    if current is None:
+        PLAYLIST_BY_ID[pid] = row
+        PLAYLISTS_BY_USER.setdefault(int(row["user_id"]), {})[pid] = row
+    else:
+        current.update(row)  # keeps its position in the owner's listing
+
+
+def reload_all(conn: sqlite3.Connection) -> int:
+    """Replace all in-memory users/playlists; returns the change seq they reflect."""
+    with conn:  # one transaction, so the snapshot and the seq agree
+        conn.execute("BEGIN")
+        seq = last_change_seq(conn)
+        set_users(load_users(conn))
+        set_playlists(load_playlists(conn))
+    return seq
+
+
+# Load once at import (before any fork) and close: SQLite connections must not cross fork()
+with closing(open_database(DATABASE_FILE)) as _conn:
+    import_json_stores(_conn)
+    _changes_seen = reload_all(_conn)
+logger.info("Loaded %d users and %d playlists from %s", len(USERS_BY_ID), len(PLAYLIST_BY_ID), DATABASE_FILE)
 
+TRACK_BY_ID: Dict[int, Dict[str, Any]] = {int(t["id"]): t for t in RAW_TRACKS}
+VALID_TRACK_IDS = frozenset(TRACK_BY_ID)
+# Public track fields, built once; only the absolute preview URL depends on the request
+TRACK_TEMPLATES: Dict[int, Dict[str, Any]] = {
+    tid: {k: v for k, v in t.items() if k != "preview_file"} for tid, t in TRACK_BY_ID.items()
+}
+# Search index: every track's lowered "title<US>artist", joined with NUL into one string,
+# so a query is a few C-level str.find calls instead of a Python loop over all tracks.
+# SEARCH_OFFSETS[i] is where track i's record starts in SEARCH_CORPUS.
+_FIELD_SEP, _RECORD_SEP = "\x1f", "\x00"
+SEARCH_TRACKS = tuple(RAW_TRACKS)
+_records = [f"{t['title'].lower()}{_FIELD_SEP}{t['artist'].lower()}" for t in SEARCH_TRACKS]
+SEARCH_CORPUS = _RECORD_SEP.join(_records)
+SEARCH_OFFSETS: list[int] = []
+_pos = 0
+for _r in _records:
+    SEARCH_OFFSETS.append(_pos)
+    _pos += len(_r) + len(_RECORD_SEP)
 
-def next_playlist_id() -> int:
-    return max((int(p["id"]) for p in RAW_PLAYLISTS), default=0) + 1
+# ----------------------------
+# Helpers: persistence
+# ----------------------------
+# Mutations are written straight to the matching rows; reads stay on the in-memory dicts.
+# Each worker process lazily opens its own connection.
+_db_conn: Optional[sqlite3.Connection] = None
+_db_pid: Optional[int] = None
+_db_data_version: Optional[int] = None
+
+
+def get_db() -> sqlite3.Connection:
+    global _db_conn, _db_pid, _db_data_version
+    if _db_conn is None or _db_pid != os.getpid():
+        _db_conn = open_database(DATABASE_FILE)
+        _db_pid = os.getpid()
+        _db_data_version = None  # force a check: commits may have landed since the fork
+    return _db_conn
+
+
+def close_db() -> None:
+    global _db_conn
+    if _db_conn is not None and _db_pid == os.getpid():
+        _db_conn.close()
+    _db_conn = None
+
+
+def sync_from_db() -> None:
+    """Apply rows changed by other worker processes since the last check."""
+    global _db_data_version, _changes_seen
+    conn = get_db()
+    # data_version only changes for commits made through *other* connections
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if version == _db_data_version:
+        return
+    _db_data_version = version
+
+    changes = conn.execute(
+        "SELECT seq, kind, row_id FROM changes WHERE seq > ? ORDER BY seq", (_changes_seen,)
+    ).fetchall()
+    if not changes:
+        return
+    if changes[0]["seq"] != _changes_seen + 1:
+        # The rows we missed were pruned already; start over from a full snapshot
+        _changes_seen = reload_all(conn)
+        return
+    for kind, row_id in {(c["kind"], c["row_id"]) for c in changes}:
+        if kind == "user":
+            apply_user(row_id, load_user(conn, row_id))
+        elif kind == "playlist":
+            apply_playlist(row_id, load_playlist(conn, row_id))
+    _changes_seen = changes[-1]["seq"]
+
+
+def _log_change(conn: sqlite3.Connection, kind: str, row_id: int) -> None:
+    cur = conn.execute("INSERT INTO changes (kind, row_id) VALUES (?, ?)", (kind, row_id))
+    conn.execute("DELETE FROM changes WHERE seq <= ?", (cur.lastrowid - CHANGES_KEPT,))
+
+
+def insert_user(user: Dict[str, Any]) -> int:
+    """Insert a new user and return its id; raises sqlite3.IntegrityError on a duplicate email."""
+    conn = get_db()
+    with conn:
+        cur = conn.execute(
+            "INSERT INTO users (email, password, name, role) VALUES (?, ?, ?, ?)",
+            (user["email"], user["password"], user.get("name", ""), user.get("role", "user")),
+        )
+        _log_change(conn, "user", cur.lastrowid)
+    return cur.lastrowid
+
+
+def update_user_password(uid: int, hashed: str) -> None:
+    conn = get_db()
+    with conn:
+        conn.execute("UPDATE users SET password = ? WHERE id = ?", (hashed, uid))
+        _log_change(conn, "user", uid)
+
+
+def insert_playlist(pl: Dict[str, Any]) -> int:
+    conn = get_db()
+    with conn:
+        cur = conn.execute(
+            "INSERT INTO playlists (user_id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (int(pl["user_id"]), pl["name"], pl.get("created_at"), pl.get("updated_at")),
+        )
+        _write_playlist_tracks(conn, cur.lastrowid, pl.get("tracks", []))
+        _log_change(conn, "playlist", cur.lastrowid)
+    return cur.lastrowid
+
+
+def update_playlist_row(pl: Dict[str, Any]) -> None:
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "UPDATE playlists SET name = ?, updated_at = ? WHERE id = ?",
+            (pl["name"], pl.get("updated_at"), int(pl["id"])),
+        )
+        _write_playlist_tracks(conn, int(pl["id"]), pl.get("tracks", []))
+        _log_change(conn, "playlist", int(pl["id"]))
+
+
+def delete_playlist_row(pid: int) -> None:
+    conn = get_db()
+    with conn:
+        conn.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (pid,))
+        conn.execute("DELETE FROM playlists WHERE id = ?", (pid,))
+        _log_change(conn, "playlist", pid)
 
 
 # ----------------------------
 # Auth (JWT via httpOnly cookie)
 # ----------------------------
+def _normalize_email(v: Any) -> Any:
+    return v.strip().lower() if isinstance(v, str) else v
+
+
+# Normalized once at parse time, so handlers can use body.email as the lookup key
+NormalizedEmail = Annotated[EmailStr, BeforeValidator(_normalize_email)]
+
+
 class LoginIn(BaseModel):
-    email: EmailStr
+    email: NormalizedEmail
     password: str
 
 
 class SignupIn(BaseModel):
-    email: EmailStr
+    email: NormalizedEmail
     password: str
     name: Optional[str] = ""
 
@@ -162,42 +547,55 @@ def to_public_user(user: Dict[str, Any]) -> PublicUser:
     )
 
 
-def get_current_user(access_token: Optional[str] = Cookie(default=None)):
+async def get_current_user(access_token: Optional[str] = Cookie(default=None)):
     if not access_token:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
     try:
-        payload = jwt.decode(access_token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = _decode_token_cached(access_token)
+        if payload.get("exp", 0) <= time.time():
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
         uid = payload.get("sub")
         if uid is None:
             raise HTTPException(status_code=401, detail="Invalid token payload")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
-    for u in RAW_USERS:
-        if int(u["id"]) == int(uid):
-            return u
-    raise HTTPException(status_code=401, detail="User not found")
+    # Only requests with a valid token pay for the cross-worker sync
+    sync_from_db()
+    u = USERS_BY_ID.get(int(uid))
+    if u is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    return u
 
 
 @app.post("/auth/signup", response_model=LoginOut)
-def signup(body: SignupIn, response: Response):
-    email = body.email.lower().strip()
+async def signup(body: SignupIn, response: Response):
+    sync_from_db()
+    email = body.email
     if email in USERS_BY_EMAIL:
         raise HTTPException(status_code=400, detail="Email already registered")
     if len(body.password) < 6:
         raise HTTPException(status_code=400, detail="Password must be at least 6 characters")
 
+    # Hash off the event loop, then re-check: another signup may have won the race meanwhile
+    hashed = await anyio.to_thread.run_sync(hash_password, body.password)
+    if email in USERS_BY_EMAIL:
+        raise HTTPException(status_code=400, detail="Email already registered")
+
     new_user = {
-        "id": next_user_id(),
         "email": email,
-        "password": hash_password(body.password),
+        "password": hashed,
         "name": body.name or email.split("@")[0],
         "role": "user",
     }
-    RAW_USERS.append(new_user)
+    try:
+        new_user["id"] = insert_user(new_user)
+    except sqlite3.IntegrityError:
+        # Registered through another worker process in the meantime
+        raise HTTPException(status_code=400, detail="Email already registered")
     USERS_BY_EMAIL[email] = new_user
-    save_users_to_file()
+    USERS_BY_ID[new_user["id"]] = new_user
     logger.info("User signup: %s (id=%s)", email, new_user["id"])
 
     token = create_access_token({"sub": str(new_user["id"])})
@@ -212,12 +610,21 @@ def signup(body: SignupIn, response: Response):
 
 
 @app.post("/auth/login", response_model=LoginOut)
-def login(body: LoginIn, response: Response):
-    email = body.email.lower().strip()
+async def login(body: LoginIn, response: Response):
+    sync_from_db()
+    email = body.email
     user = USERS_BY_EMAIL.get(email)
-    if not user or not verify_password(body.password, user.get("password", "")):
+    # Unknown emails still pay for one hash check, so timing doesn't reveal which accounts exist
+    stored_hash = user.get("password") if user else None
+    valid, new_hash = await anyio.to_thread.run_sync(verify_password, body.password, stored_hash)
+    if not user or not valid:
         logger.info("Failed login for %s", body.email)
         raise HTTPException(status_code=401, detail="Invalid email or password")
+    if new_hash:
+        user["password"] = new_hash
+        update_user_password(int(user["id"]), new_hash)
+        track_hash_scheme(user)
+        logger.info("Upgraded password hash for user id=%s", user["id"])
 
     token = create_access_token({"sub": str(user["id"])})
     response.set_cookie(
@@ -232,47 +639,92 @@ def login(body: LoginIn, response: Response):
 
 
 @app.post("/auth/logout")
-def logout(response: Response):
+async def logout(response: Response):
     response.delete_cookie("access_token")
     logger.info("Logout cookie cleared")
     return {"ok": True}
 
 
 @app.get("/auth/me", response_model=PublicUser)
-def me(current=Depends(get_current_user)):
+async def me(current=Depends(get_current_user)):
     return to_public_user(current)
 
 
 # ----------------------------
 # Tracks
 # ----------------------------
-def absolute_audio_url(request: Request, filename: str) -> str:
+def audio_base_url(request: Request) -> str:
+    if AUDIO_BASE_URL:
+        return AUDIO_BASE_URL
     base = str(request.base_url).rstrip("/")
-    return f"{base}/audio/{filename}"
+    return f"{base}/audio"
+
+
+def serialize_track(audio_base: str, t: dict) -> dict:
+    return {**TRACK_TEMPLATES[int(t["id"])], "preview": f"{audio_base}/{t['preview_file']}"}
+
+
+# The full /tracks payload is identical for every caller except for the host, so
+# encode it once with a placeholder and splice the request's audio base URL in.
+AUDIO_BASE_PLACEHOLDER = "__SPOTIFAUX_AUDIO_BASE__"
+TRACKS_BODY_TEMPLATE: bytes = orjson.dumps(
+    [serialize_track(AUDIO_BASE_PLACEHOLDER, t) for t in RAW_TRACKS]
+)
+
+
+@lru_cache(maxsize=64)  # keyed on the audio base URL, which is host-derived, so keep it bounded
+def tracks_body_and_etag(audio_base: str) -> tuple[bytes, str]:
+    # The tag hashes the final body: preview URLs differ per base (e.g. after switching
+    # AUDIO_BASE_URL), and a stale 304 would leave clients with dead links.
+    escaped = orjson.dumps(audio_base)[1:-1]  # JSON-escaped, without quotes
+    body = TRACKS_BODY_TEMPLATE.replace(AUDIO_BASE_PLACEHOLDER.encode(), escaped)
+    return body, '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
 
 
-def serialize_track(request: Request, t: dict) -> dict:
-    out = {k: v for k, v in t.items() if k != "preview_file"}
-    out["preview"] = absolute_audio_url(request, t["preview_file"])
-    return out
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [c.strip().removeprefix("W/") for c in header.split(",")]
+    return etag in candidates or "*" in candidates
 
 
-@app.get("/tracks")
-def list_tracks(request: Request):
+@app.get("/tracks", response_model=None)
+async def list_tracks(request: Request):
     logger.info("GET /tracks called")
-    return [serialize_track(request, t) for t in RAW_TRACKS]
+    body, etag = tracks_body_and_etag(audio_base_url(request))
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+def find_tracks(ql: str) -> list:
+    """Tracks whose lowered title or artist contains ql, in catalog order."""
+    if not ql:
+        return list(SEARCH_TRACKS)
+    if _FIELD_SEP in ql or _RECORD_SEP in ql:
+        return []  # would only match across field boundaries
+    hits = []
+    pos = SEARCH_CORPUS.find(ql)
+    while pos != -1:
+        i = bisect.bisect_right(SEARCH_OFFSETS, pos) - 1
+        hits.append(SEARCH_TRACKS[i])
+        if i + 1 == len(SEARCH_OFFSETS):
+            break
+        # One hit per track is enough; resume at the next record
+        pos = SEARCH_CORPUS.find(ql, SEARCH_OFFSETS[i + 1])
+    return hits
 
 
-@app.get("/search")
-def search_tracks(q: str, request: Request):
+@app.get("/search", response_model=None)
+async def search_tracks(q: str, request: Request):
     logger.info("GET /search called with query: %s", q)
     ql = q.lower()
-    filtered = [
-        t for t in RAW_TRACKS
-        if ql in t["title"].lower() or ql in t["artist"].lower()
-    ]
+    filtered = find_tracks(ql)
     logger.info("Search returned %d results", len(filtered))
-    return [serialize_track(request, t) for t in filtered]
+    audio_base = audio_base_url(request)
+    # Returned as a response so FastAPI skips its jsonable_encoder pass over the dicts
+    return ORJSONResponse([serialize_track(audio_base, t) for t in filtered])
 
 
 # ----------------------------
@@ -297,28 +749,30 @@ class PlaylistOut(BaseModel):
     updated_at: Optional[str] = None
 
 
-def validate_track_ids(track_ids):
-    bad = [tid for tid in track_ids if int(tid) not in TRACK_BY_ID]
+def validate_track_ids(track_ids: list[int]):
+    # Ids are already ints (validated by the request model); one set op finds the unknown ones
+    bad = sorted(set(track_ids).difference(VALID_TRACK_IDS))
     if bad:
         raise HTTPException(status_code=400, detail=f"Unknown track ids: {bad}")
 
 
 def populate_playlist(request: Request, pl: dict) -> dict:
     enriched = {k: v for k, v in pl.items()}
+    audio_base = audio_base_url(request)
     tracks_full = []
     for tid in pl.get("tracks", []):
         t = TRACK_BY_ID.get(int(tid))
         if t:
-            tracks_full.append(serialize_track(request, t))
+            tracks_full.append(serialize_track(audio_base, t))
     enriched["tracks"] = tracks_full
     return enriched
 
 
 def get_playlist_or_404(pid: int) -> dict:
-    for p in RAW_PLAYLISTS:
-        if int(p["id"]) == int(pid):
-            return p
-    raise HTTPException(status_code=404, detail="Playlist not found")
+    p = PLAYLIST_BY_ID.get(int(pid))
+    if p is None:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    return p
 
 
 def assert_owner(playlist: dict, user: dict):
@@ -326,63 +780,65 @@ def assert_owner(playlist: dict, user: dict):
         raise HTTPException(status_code=403, detail="Forbidden")
 
 
-@app.get("/playlists", response_model=list[PlaylistOut])
-def list_playlists(request: Request, current=Depends(get_current_user)):
+# Read paths return the trusted server-side dicts as-is; PlaylistOut only documents them
+@app.get("/playlists", responses={200: {"model": list[PlaylistOut]}})
+async def list_playlists(request: Request, current=Depends(get_current_user)):
     user_id = int(current["id"])
-    own = [p for p in RAW_PLAYLISTS if int(p.get("user_id")) == user_id]
-    return [populate_playlist(request, p) for p in own]
+    own = PLAYLISTS_BY_USER.get(user_id, {}).values()
+    return ORJSONResponse([populate_playlist(request, p) for p in own])
 
 
-@app.get("/playlists/{pid}", response_model=PlaylistOut)
-def get_playlist(pid: int, request: Request, current=Depends(get_current_user)):
+@app.get("/playlists/{pid}", responses={200: {"model": PlaylistOut}})
+async def get_playlist(pid: int, request: Request, current=Depends(get_current_user)):
     pl = get_playlist_or_404(pid)
     assert_owner(pl, current)
-    return populate_playlist(request, pl)
+    return ORJSONResponse(populate_playlist(request, pl))
 
 
 @app.post("/playlists", response_model=PlaylistOut, status_code=201)
-def create_playlist(body: PlaylistIn, request: Request, current=Depends(get_current_user)):
+async def create_playlist(body: PlaylistIn, request: Request, current=Depends(get_current_user)):
     validate_track_ids(body.tracks)
     now = datetime.utcnow().isoformat() + "Z"
     new_pl = {
-        "id": next_playlist_id(),
         "user_id": int(current["id"]),
         "name": body.name.strip(),
-        "tracks": [int(t) for t in body.tracks],
+        "tracks": list(body.tracks),
         "created_at": now,
         "updated_at": now,
     }
-    RAW_PLAYLISTS.append(new_pl)
-    save_playlists_to_file()
+    new_pl = {"id": insert_playlist(new_pl), **new_pl}
+    PLAYLIST_BY_ID[new_pl["id"]] = new_pl
+    PLAYLISTS_BY_USER.setdefault(new_pl["user_id"], {})[new_pl["id"]] = new_pl
     logger.info("Playlist created id=%s by user_id=%s", new_pl["id"], current["id"])
     return populate_playlist(request, new_pl)
 
 
 @app.put("/playlists/{pid}", response_model=PlaylistOut)
-def update_playlist(pid: int, body: PlaylistUpdate, request: Request, current=Depends(get_current_user)):
+async def update_playlist(pid: int, body: PlaylistUpdate, request: Request, current=Depends(get_current_user)):
     pl = get_playlist_or_404(pid)
     assert_owner(pl, current)
 
-    if body.name is not None:
-        pl["name"] = body.name.strip()
     if body.tracks is not None:
         validate_track_ids(body.tracks)
-        pl["tracks"] = [int(t) for t in body.tracks]
 
-    pl["updated_at"] = datetime.utcnow().isoformat() + "Z"
-    save_playlists_to_file()
+    # Write the new values first; the cached dict only changes once the row is saved
+    changes = {"updated_at": datetime.utcnow().isoformat() + "Z"}
+    if body.name is not None:
+        changes["name"] = body.name.strip()
+    if body.tracks is not None:
+        changes["tracks"] = list(body.tracks)
+    update_playlist_row({**pl, **changes})
+    pl.update(changes)
     logger.info("Playlist updated id=%s by user_id=%s", pl["id"], current["id"])
     return populate_playlist(request, pl)
 
 
 @app.delete("/playlists/{pid}", status_code=204)
-def delete_playlist(pid: int, current=Depends(get_current_user)):
+async def delete_playlist(pid: int, current=Depends(get_current_user)):
     pl = get_playlist_or_404(pid)
     assert_owner(pl, current)
-    for i, p in enumerate(RAW_PLAYLISTS):
-        if int(p["id"]) == int(pid):
-            RAW_PLAYLISTS.pop(i)
-            break
-    save_playlists_to_file()
+    delete_playlist_row(int(pid))
+    PLAYLIST_BY_ID.pop(int(pid))
+    PLAYLISTS_BY_USER[int(pl["user_id"])].pop(int(pid))
     logger.info("Playlist deleted id=%s by user_id=%s", pid, current["id"])
     return
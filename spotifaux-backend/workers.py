@@ -0,0 +1,14 @@
+# Gunicorn worker class for the API (see gunicorn_conf.py).
+import os
+
+from uvicorn_worker import UvicornWorker
+
+
+class SpotifauxUvicornWorker(UvicornWorker):
+    # Same runtime as the plain uvicorn command line: uvloop + httptools, and a cap
+    # on concurrent connections so an overloaded worker answers 503 instead of queueing.
+    CONFIG_KWARGS = {
+        "loop": "uvloop",
+        "http": "httptools",
+        "limit_concurrency": int(os.getenv("LIMIT_CONCURRENCY", "1024")),
+    }